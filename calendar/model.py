@@ -2,7 +2,8 @@ from datetime import datetime, timezone, date
 from typing import Optional, Annotated
 from enum import Enum
 
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, func, text, CheckConstraint, Text
+from sqlalchemy import Table, Column, Integer, String, DateTime, MetaData, ForeignKey, func, text, CheckConstraint, Text, Computed, Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR, ARRAY
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from  database import Base, str_200
@@ -22,6 +23,7 @@ class UserORM(Base):
 
     moods = relationship("MoodORM", back_populates="user", cascade="all, delete-orphan")
     average_moods = relationship("AverageMoodORM", back_populates="user", cascade="all, delete-orphan")
+    archived_moods = relationship("MoodArchiveORM", back_populates="user", cascade="all, delete-orphan")
 
 class PersonalMoodORM(Base):
     '''
@@ -69,9 +71,13 @@ class MoodORM(Base):
     mood: настроение
     weight: вес настроения: очень плохое (-2), плохое (-1), нейтральное (0), позитивное (1), очень позитивное (2)
     why: причины настроения (можно оставлять пустым)
+    why_tsv: генерируемый tsvector по why сразу в русской и английской конфигурациях, под GIN индексом для полнотекстового поиска
     '''
 
     __tablename__ = 'moods_orm'
+    __table_args__ = (
+        Index('ix_moods_orm_why_tsv', 'why_tsv', postgresql_using='gin'),
+    )
 
     id: Mapped[intpk]
     user_id: Mapped[str_200] = mapped_column(foreign_key='users_orm.user_id', index=True)
@@ -79,6 +85,14 @@ class MoodORM(Base):
     mood: Mapped[MoodsEnum]
     weight: Mapped[WeightEnun]
     why: Mapped[str] = mapped_column(Text, nullable=True)
+    why_tsv: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed(
+            "to_tsvector('russian', coalesce(why, '')) || to_tsvector('english', coalesce(why, ''))",
+            persisted=True,
+        ),
+        nullable=True,
+    )
     date: Mapped[datetime] = mapped_column(server_default=text("TIMEZONE('utc', now())"))
 
 class AverageMoodORM(Base):
@@ -96,4 +110,35 @@ class AverageMoodORM(Base):
         nullable=True,  # Делаем поле необязательным
         check=CheckConstraint("avg_mood_weight IN (-2, -1, 0, 1, 2) OR avg_mood_weight IS NULL")  # Учитываем значение NULL
     )
-    date: Mapped[date]
\ No newline at end of file
+    date: Mapped[date]
+
+class MoodArchiveORM(Base):
+    '''
+    Холодный архив старых записей MoodORM: одна строка на пользователя и месяц, записи упакованы в параллельные массивы
+    user_id: привязка к юзеру
+    month: первый день архивного месяца
+    ids, dates, moods, weights, whys: поля исходных записей MoodORM; mood и weight хранятся именами из MoodsEnum и WeightEnun.
+        Внутри одного прохода архивации записи идут в порядке (date, id), повторный проход дописывает записи в конец массивов,
+        поэтому читатели сортируют распакованные записи сами
+    whys_tsvs: сохранённые MoodORM.why_tsv каждой записи, чтобы поиск не пересчитывал to_tsvector при распаковке
+    whys_tsv: tsvector по всем why месяца в русской и английской конфигурациях, под GIN индексом —
+        по нему поиск отбирает архивные месяцы, в которых есть совпадения
+    '''
+
+    __tablename__ = 'moods_archive_orm'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'month', name='uq_moods_archive_orm_user_id_month'),
+        Index('ix_moods_archive_orm_whys_tsv', 'whys_tsv', postgresql_using='gin'),
+    )
+
+    id: Mapped[intpk]
+    user_id: Mapped[str_200] = mapped_column(ForeignKey('users_orm.user_id', ondelete='CASCADE'))
+    user: Mapped[UserORM] = relationship("UserORM", back_populates="archived_moods")
+    month: Mapped[date]
+    ids: Mapped[list[int]] = mapped_column(ARRAY(Integer))
+    dates: Mapped[list[datetime]] = mapped_column(ARRAY(DateTime))
+    moods: Mapped[list[str]] = mapped_column(ARRAY(String(200)))
+    weights: Mapped[list[str]] = mapped_column(ARRAY(String(200)))
+    whys: Mapped[list[Optional[str]]] = mapped_column(ARRAY(Text))
+    whys_tsvs: Mapped[list[str]] = mapped_column(ARRAY(TSVECTOR))
+    whys_tsv: Mapped[str] = mapped_column(TSVECTOR, nullable=True)
@@ -1,6 +1,7 @@
 from calendar import month
 
-from sqlalchemy import select, func, cast
+from sqlalchemy import select, delete, func, cast, case, column, literal, literal_column, true, tuple_, union_all, Date, DateTime, Interval
+from sqlalchemy.dialects.postgresql import REGCONFIG, TSQUERY, TSVECTOR, aggregate_order_by, insert as pg_insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import session
 from sqlalchemy.orm.loading import instances
@@ -273,6 +274,110 @@ def avg_user_mood_set_worker() -> str:
 
     return "Success"
 
+def archive_old_user_moods(older_than_days: int = 365, batch_size: int = 50) -> str:
+    '''
+    1. Запускать функцию по расписанию (например, раз в месяц)
+    2. Находит все пары (user_id, месяц) в MoodORM, целиком лежащие раньше, чем older_than_days дней назад
+       (граница выравнивается на начало месяца, чтобы архивный месяц не оказался разрезан)
+    3. Для каждой пары одним INSERT ... SELECT упаковывает записи в строку MoodArchiveORM с массивами в порядке (date, id)
+       вместе с tsvector каждой записи, и считает tsvector по всем why месяца, чтобы архивные записи оставались доступны
+       search_user_mood_notes.
+       Если строка за этот месяц уже есть, новые записи дописываются в конец массивов (порядок (date, id) при этом
+       не сохраняется, get_user_moods_for_period сортирует записи после распаковки)
+    4. Удаляет из MoodORM ровно упакованные записи: удаление и упаковка — одно выражение WITH DELETE ... RETURNING / INSERT ... SELECT.
+       Коммит — каждые batch_size месяцев, чтобы не держать долгих блокировок на горячей таблице
+    :return: "Success" или строка с ошибкой
+    '''
+
+    if not isinstance(older_than_days, int) or older_than_days < 0:
+        raise ValueError('older_than_days must be a non-negative integer')
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError('batch_size must be a positive integer')
+
+    total_time_start = datetime.now()
+    total_months_archived = 0
+    total_records_deleted = 0
+
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).date().replace(day=1)
+    cutoff_date = datetime.combine(cutoff, time.min)
+
+    month_start = truncate_date('month', MoodORM.date)
+
+    with sync_session_fabric() as session:
+        try:
+            user_months = session.query(MoodORM.user_id, month_start.label('month')).filter(
+                MoodORM.date < cutoff_date,
+            ).group_by(MoodORM.user_id, month_start).order_by(MoodORM.user_id, month_start).all()
+
+            logger.info(f'Found {len(user_months)} user months older than {cutoff} for archiving.')
+
+            for batch_start in range(0, len(user_months), batch_size):
+                for user_id, month in user_months[batch_start:batch_start + batch_size]:
+                    month_end = (month + timedelta(days=32)).replace(day=1)
+                    in_month = (
+                        MoodORM.user_id == user_id,
+                        MoodORM.date >= month,
+                        MoodORM.date < month_end,
+                    )
+
+                    # Упаковываются ровно те строки, которые удалены: DELETE ... RETURNING кормит INSERT ... SELECT
+                    # в одном выражении, поэтому запись, вставленная между ними задним числом, не потеряется
+                    archived_rows = delete(MoodORM).where(*in_month).returning(
+                        MoodORM.id, MoodORM.user_id, MoodORM.date, MoodORM.mood, MoodORM.weight, MoodORM.why, MoodORM.why_tsv,
+                    ).cte('archived_rows')
+                    ordering = (archived_rows.c.date, archived_rows.c.id)
+
+                    packed = select(
+                        archived_rows.c.user_id,
+                        literal(month.date(), Date),
+                        func.array_agg(aggregate_order_by(archived_rows.c.id, *ordering)),
+                        func.array_agg(aggregate_order_by(archived_rows.c.date, *ordering)),
+                        func.array_agg(aggregate_order_by(cast(archived_rows.c.mood, String), *ordering)),
+                        func.array_agg(aggregate_order_by(cast(archived_rows.c.weight, String), *ordering)),
+                        func.array_agg(aggregate_order_by(archived_rows.c.why, *ordering)),
+                        func.array_agg(aggregate_order_by(archived_rows.c.why_tsv, *ordering)),
+                        get_mood_notes_tsvector(func.string_agg(archived_rows.c.why, ' ')),
+                    ).group_by(archived_rows.c.user_id)
+
+                    packed_columns = ['ids', 'dates', 'moods', 'weights', 'whys', 'whys_tsvs']
+                    insert_stmt = pg_insert(MoodArchiveORM).from_select(
+                        ['user_id', 'month'] + packed_columns + ['whys_tsv'], packed
+                    )
+                    set_columns = {
+                        packed_column: func.array_cat(getattr(MoodArchiveORM, packed_column), getattr(insert_stmt.excluded, packed_column))
+                        for packed_column in packed_columns
+                    }
+                    set_columns['whys_tsv'] = MoodArchiveORM.whys_tsv.op('||', return_type=TSVECTOR)(insert_stmt.excluded.whys_tsv)
+                    insert_stmt = insert_stmt.on_conflict_do_update(
+                        constraint='uq_moods_archive_orm_user_id_month',
+                        set_=set_columns,
+                    ).returning(MoodArchiveORM.id)
+
+                    deleted = session.execute(
+                        select(func.count()).select_from(archived_rows).add_cte(insert_stmt.cte('packed'))
+                    ).scalar()
+
+                    total_months_archived += 1
+                    total_records_deleted += deleted
+                    logger.info(f'Archived {deleted} records for user_id {user_id} for month {month.date()}')
+
+                session.commit()
+                logger.info(f'Archived {total_months_archived} / {len(user_months)} user months.')
+
+        except Exception as e:
+            session.rollback()
+            logger.error(f'ERROR during the archive operation : {str(e)}')
+            return f'ERROR during the archive operation : {str(e)}'
+
+        finally:
+            total_time_end = datetime.now()
+            logger.info(
+                f'Total time for archive : {total_time_end - total_time_start} : archived {total_months_archived} '
+                f'user months : deleted {total_records_deleted} records'
+            )
+
+    return "Success"
+
 def get_days_in_month(year, month) -> int:
     if month in (1, 3, 5, 7, 8, 10, 12):
         return 31
@@ -324,6 +429,180 @@ def check_input_dates(start_period_year,
     DatesTuple = namedtuple('DatesTuple', ['start_date', 'end_date'])
     return DatesTuple(start_date=start_date, end_date=end_date)
 
+STATISTIC_BUCKETS = ('hour', 'day', 'week', 'month', 'year')
+
+
+def truncate_date(bucket: str, date_column):
+    '''
+    date_trunc(bucket, date_column), где bucket подставляется литералом, а не параметром:
+    Postgres принимает выражение в GROUP BY, только если его текст совпадает с текстом в SELECT
+    :param bucket: одно из STATISTIC_BUCKETS
+    '''
+    if bucket not in STATISTIC_BUCKETS:
+        raise ValueError(f'bucket должен быть одним из {STATISTIC_BUCKETS}')
+    return func.date_trunc(literal_column(f"'{bucket}'"), date_column)
+
+
+def _get_weight_value(weight_name):
+    '''
+    weight хранится как имя члена WeightEnun, а каста enum -> integer в Postgres нет, поэтому переводим имя в число
+    '''
+    return case(
+        {name: member.value for name, member in WeightEnun.__members__.items()},
+        value=weight_name,
+    )
+
+
+def _get_bucket_source(bucket: str, user_id: str, start_period: datetime, end_period: datetime):
+    '''
+    Возвращает самый компактный источник данных, из которого можно собрать бакет нужной гранулярности:
+    часы считаются по сырым записям MoodORM вместе с распакованными архивными месяцами MoodArchiveORM,
+    всё начиная с дня — по дневным средним из AverageMoodORM, которые архивация не трогает
+    :return: subquery с колонками date и weight за период [start_period, end_period]
+    '''
+    if bucket != 'hour':
+        return select(
+            AverageMoodORM.date.label('date'),
+            AverageMoodORM.avg_mood_weight.label('weight'),
+        ).filter(
+            AverageMoodORM.user_id == user_id,
+            AverageMoodORM.date >= start_period,
+            AverageMoodORM.date <= end_period,
+        ).subquery('source')
+
+    hot = select(
+        MoodORM.date.label('date'),
+        _get_weight_value(cast(MoodORM.weight, String)).label('weight'),
+    ).filter(
+        MoodORM.user_id == user_id,
+        MoodORM.date >= start_period,
+        MoodORM.date <= end_period,
+    )
+
+    unpacked = func.unnest(MoodArchiveORM.dates, MoodArchiveORM.weights).table_valued(
+        column('date', DateTime), column('weight', String),
+    ).render_derived(name='unpacked')
+    archived = select(
+        unpacked.c.date,
+        _get_weight_value(unpacked.c.weight).label('weight'),
+    ).select_from(MoodArchiveORM).join(unpacked, true()).filter(
+        MoodArchiveORM.user_id == user_id,
+        MoodArchiveORM.month >= start_period.date().replace(day=1),
+        MoodArchiveORM.month <= end_period.date(),
+        unpacked.c.date >= start_period,
+        unpacked.c.date <= end_period,
+    )
+
+    return union_all(hot, archived).subquery('source')
+
+
+def get_bucketed_statistic_user_mood(user_id: str,
+                                     start_period: date,
+                                     end_period: date,
+                                     bucket: str = 'day'
+                                     ) -> tuple | None:
+    '''
+    1. Разбивает период [start_period, end_period] на бакеты bucket: hour, day, week, month или year
+       (начало бакета считается через date_trunc, неделя начинается с понедельника)
+    2. Усреднение weight делается одним запросом на стороне БД: GROUP BY по date_trunc.
+       Часы считаются по сырым записям, в том числе уже перенесённым в архив MoodArchiveORM
+    3. Пропуски заполняются через generate_series: у бакетов без записей значение None
+    :return: (bucket, {начало_бакета: avg_weight}) или None, если за период нет ни одной записи.
+             Для bucket == 'hour' ключи — datetime, для остальных — date
+    '''
+
+    if bucket not in STATISTIC_BUCKETS:
+        logger.error(f'ERROR: incorrect bucket value: {bucket}')
+        raise ValueError(f'bucket должен быть одним из {STATISTIC_BUCKETS}')
+
+    if not isinstance(start_period, datetime):
+        start_period = datetime.combine(start_period, time.min)
+    if not isinstance(end_period, datetime):
+        end_period = datetime.combine(end_period, time.max)
+
+    if start_period > end_period:
+        raise ValueError('Start date must be less than or equal to end date.')
+
+    source = _get_bucket_source(bucket, user_id, start_period, end_period)
+
+    series = select(
+        func.generate_series(
+            truncate_date(bucket, cast(start_period, DateTime)),
+            cast(end_period, DateTime),
+            cast(f'1 {bucket}', Interval),
+        ).label('bucket')
+    ).subquery('series')
+
+    bucket_start = truncate_date(bucket, cast(source.c.date, DateTime))
+    aggregated = select(
+        bucket_start.label('bucket'),
+        func.avg(source.c.weight).label('avg_mood_weight'),
+    ).group_by(bucket_start).subquery('aggregated')
+
+    with sync_session_fabric() as session:
+        try:
+            query = session.execute(
+                select(series.c.bucket, aggregated.c.avg_mood_weight)
+                .select_from(series.outerjoin(aggregated, aggregated.c.bucket == series.c.bucket))
+                .order_by(series.c.bucket)
+            ).all()
+
+        except Exception as e:
+            logger.error(f'ERROR for user_id {user_id} : {str(e)}')
+            raise Exception(f'ERROR: {e}')
+
+    if all(row.avg_mood_weight is None for row in query):
+        return None
+
+    weight_dict = dict()
+    for row in query:
+        key = row.bucket if bucket == 'hour' else row.bucket.date()
+        weight_dict[key] = None if row.avg_mood_weight is None else float(row.avg_mood_weight)
+
+    logger.info(f'For {user_id=} extracted {len(weight_dict)} {bucket} buckets from {start_period} to {end_period}.')
+
+    return (bucket, weight_dict)
+
+
+ArchivedMood = namedtuple('ArchivedMood', ['id', 'user_id', 'date', 'mood', 'weight', 'why'])
+
+
+def get_user_moods_for_period(session, user_id: str, start_date: datetime, end_date: datetime) -> list:
+    '''
+    Возвращает записи настроения пользователя за период [start_date, end_date] в порядке (date, id).
+    Читает и горячую таблицу MoodORM, и архивные месяцы из MoodArchiveORM: период может пересекать границу архива,
+    а запись задним числом может попасть в MoodORM уже после архивации своего месяца
+    :return: list of MoodORM и ArchivedMood с одинаковыми полями date, mood, weight, why
+    '''
+
+    records = session.query(MoodORM).filter(
+        MoodORM.user_id == user_id,
+        MoodORM.date >= start_date,
+        MoodORM.date <= end_date,
+    ).all()
+
+    archives = session.query(MoodArchiveORM).filter(
+        MoodArchiveORM.user_id == user_id,
+        MoodArchiveORM.month >= start_date.date().replace(day=1),
+        MoodArchiveORM.month <= end_date.date(),
+    ).all()
+
+    archived_records = 0
+    for archive in archives:
+        for mood_id, mood_date, mood, weight, why in zip(archive.ids, archive.dates, archive.moods, archive.weights, archive.whys):
+            if start_date <= mood_date <= end_date:
+                records.append(ArchivedMood(mood_id, user_id, mood_date, MoodsEnum[mood], WeightEnun[weight], why))
+                archived_records += 1
+
+    if archived_records:
+        logger.info(f'For {user_id=} extracted {archived_records} archived records from {start_date} to {end_date}.')
+
+    # Массивы архива упорядочены только внутри одного прохода архивации, поэтому сортируем итог целиком
+    records.sort(key=lambda record: (record.date, record.id))
+
+    return records
+
+
 def get_statistic_user_mood(user_id: str,
                             start_period_year: int = None,
                             start_period_month: int = None,
@@ -331,17 +610,22 @@ def get_statistic_user_mood(user_id: str,
                             end_period_year: int = None,
                             end_period_month: int = None,
                             end_period_day: int = None
-                            ) -> dict:
+                            ) -> tuple | None:
     '''
     1. Получить все записи на пользователя user_id из AverageMoodORM за указанный период.
        ВАЖНО: период может быть одним конкретным днём, конкретным месяцем, конкретным годом, всем периодом существования пользователя в случае None
-    2. ЕСЛИ период ограничен конкретным днём, то берём все данные weight из на user_id из MoodORM
-    3. ИНОЕ — берём все данные weight из на user_id из AverageMoodORM за указанный период
-    4. Возвращаем dict по принципу:
-       ЕСЛИ период ограничем конкретным днём, то {'hh:mm': weight}
-       ЕСЛИ период ограничен месяцем, то {'day_number_in_the_month': weight}
-       ЕСЛИ период ограничен годом, то {'month': average_weight_for_this_month}
-    :return: dict or None. Если данные указаны за месяц, можно сформировать календарь.
+    2. ЕСЛИ период ограничен конкретным днём, то берём все данные weight из на user_id из MoodORM (или из MoodArchiveORM, если день уже в архиве)
+    3. ИНОЕ — берём все данные weight из на user_id из AverageMoodORM через get_bucketed_statistic_user_mood
+       строго за указанный период, гранулярность выбирается по его длине, а не по календарным границам
+    4. Возвращаем tuple по принципу:
+       ЕСЛИ период ограничем конкретным днём, то ('day', {date_time: weight})
+       ЕСЛИ период не длиннее 31 дня, то ('month', {date: avg_weight_for_this_day})
+       ЕСЛИ период не длиннее 92 дней, то ('week', {date_of_monday: avg_weight_for_this_week})
+       ЕСЛИ период лежит внутри одного года, то ('year', {month: average_weight_for_this_month})
+       ЕСЛИ период не длиннее 366 дней, но пересекает границу года, то ('months', {date_of_first_day: average_weight_for_this_month})
+       ИНАЧЕ ('year', {year: average_weight_for_this_year})
+       Дни, недели, месяцы и годы без записей имеют значение None; крайние бакеты усредняются только по дням внутри периода
+    :return: tuple or None. Если данные указаны за месяц, можно сформировать календарь.
     '''
 
     period = check_input_dates(start_period_year = start_period_year,
@@ -359,11 +643,7 @@ def get_statistic_user_mood(user_id: str,
 
         with sync_session_fabric() as session:
             try:
-                query = session.query(MoodORM).filter(
-                    MoodORM.user_id == user_id,
-                    MoodORM.date >= start_date,
-                    MoodORM.date <= end_date
-                ).all()
+                query = get_user_moods_for_period(session, user_id, start_date, end_date)
 
                 if not query:
                     return None
@@ -378,103 +658,42 @@ def get_statistic_user_mood(user_id: str,
 
 
 
-    # Берем выборку данных за месяц
-    elif period.start_date.month == period.end_date.month and period.start_date.year == period.end_date.year:
-        # Здесь должен быть запрос к AverageMoodORM, где уже содержится усреднение weight для каждого существующего дня
-        # Вернуть словарь {day_of_month: avg_weight_of_this_day}
-        days_in_current_month = get_days_in_month(year=period.start_date.year, month=period.start_date.month)
-
-        start_date = datetime.combine(period.start_date.replace(day=1), time.min)
-        end_date = datetime.combine(period.end_date.replace(day=days_in_current_month), time.max)
-
-        with sync_session_fabric() as session:
-            try:
-                query = session.query(AverageMoodORM).filter(
-                    AverageMoodORM.user_id == user_id,
-                    AverageMoodORM.date >= start_date,
-                    AverageMoodORM.date <= end_date
-                ).all()
-
-                if not query:
-                    return None
-
-                weight_dict = dict()
-                for date in query:
-                    weight_dict[date.date] = date.weight
-
-                return ('month', weight_dict)
-
-            except Exception as e:
-                raise Exception(f'ERROR: {e}')
-
-
-    # Берем выборку данных за год
-    elif period.start_date.year == period.end_date.year:
-        # Здесь должен быть запрос к AverageMoodORM, усреднение weight для каждого существующего месяца
-        # Вернуть словарь {month: avg_weight_of_this_month}
-
-        start_date = datetime.combine(period.start_date.replace(month=1, day=1), time.min)
-        end_date = datetime.combine(period.end_date.replace(month=12, day=31), time.max)
-
-        with sync_session_fabric() as session:
-            try:
-                query = session.query(
-                    func.extract('month', AverageMoodORM.date).label('month'),
-                    func.avg(AverageMoodORM.avg_mood_weight).label('avg_mood_weight')
-                ).filter(
-                    AverageMoodORM.user_id == user_id,
-                    AverageMoodORM.date >= start_date,
-                    AverageMoodORM.date <= end_date
-                ).group_by(func.extract('month', AverageMoodORM.date)).all()
-
-                if not query:
-                    return None
-
-                weight_dict = dict()
-                for date in query:
-                    weight_dict[int(date.month)] = date.avg_mood_weight
-
-                return ('year', weight_dict)
-
-            except Exception as e:
-                raise Exception(f'ERROR: {e}')
-
+    # Для периодов длиннее дня гранулярность зависит от длины периода, а не от того, совпадают ли месяц и год у границ.
+    # Период не расширяется до целого месяца или года
+    span_days = (period.end_date - period.start_date).days
+    same_year = period.start_date.year == period.end_date.year
 
-    # Берем выборку данных за разные годы
+    if span_days <= 31:
+        tag, bucket = 'month', 'day'
+    elif span_days <= 92:
+        tag, bucket = 'week', 'week'
+    elif same_year:
+        tag, bucket = 'year', 'month'
+    elif span_days <= 366:
+        tag, bucket = 'months', 'month'
     else:
-        # Здесь должен быть запрос к AverageMoodORM, усреднение weight для каждого существующего года
-        # Вернуть словарь {year: avg_weight_of_this_year}
-
-        start_date = datetime.combine(period.start_date.replace(month=1, day=1), time.min)
-        end_date = datetime.combine(period.end_date.replace(month=12, day=31), time.max)
-
-        with sync_session_fabric() as session:
-            try:
-                query = session.query(AverageMoodORM).filter(
-                    AverageMoodORM.user_id == user_id,
-                    AverageMoodORM.date >= start_date,
-                    AverageMoodORM.date <= end_date
-                ).all()
+        tag, bucket = 'year', 'year'
 
-                if not query:
-                    return None
-
-                weight_dict = dict()
-                for date in query:
-                    weight_dict[date.date] = date.weight
-
-                return ('year', weight_dict)
-
-            except Exception as e:
-                raise Exception(f'ERROR: {e}')
+    statistic = get_bucketed_statistic_user_mood(user_id=user_id,
+                                                 start_period=period.start_date,
+                                                 end_period=period.end_date,
+                                                 bucket=bucket)
+    if statistic is None:
+        return None
 
+    weight_dict = statistic[1]
+    if tag == 'year' and bucket == 'month':
+        weight_dict = {month_start.month: weight for month_start, weight in weight_dict.items()}
+    elif tag == 'year':
+        weight_dict = {year_start.year: weight for year_start, weight in weight_dict.items()}
 
+    return (tag, weight_dict)
 
 
 def get_detail_day_statistic_user_mood(user_id: str, target_date: date = None) -> dict | None:
     '''
     1. Получить все записи на пользователя user_id из AverageMoodORM за указанный день, формат гггг.мм.дд. Если None - данные за вчера.
-    2. Берём все данные weight, mood и why на user_id из MoodORM
+    2. Берём все данные weight, mood и why на user_id из MoodORM, а если день уже в архиве — из MoodArchiveORM
     :return: dict {mood: (time hh:mm, weight, why)} или None
     '''
 
@@ -487,11 +706,7 @@ def get_detail_day_statistic_user_mood(user_id: str, target_date: date = None) -
 
     with sync_session_fabric() as session:
         # Запрашиваем все записи для пользователя за указанный день
-        query = session.query(MoodORM).filter(
-            MoodORM.user_id == user_id,
-            MoodORM.date >= start_of_day,
-            MoodORM.date <= end_of_day,
-        ).all()
+        query = get_user_moods_for_period(session, user_id, start_of_day, end_of_day)
 
     # Если не найдено записей, возвращаем None
     if not query:
@@ -513,3 +728,148 @@ def get_detail_day_statistic_user_mood(user_id: str, target_date: date = None) -
     return mood_statistics
 
 
+SEARCH_CONFIGS = ('russian', 'english')
+
+
+def get_mood_notes_tsvector(notes):
+    '''
+    tsvector по тексту заметок сразу во всех SEARCH_CONFIGS — то же выражение, что и у генерируемой колонки MoodORM.why_tsv
+    '''
+    vector = None
+    for config in SEARCH_CONFIGS:
+        config_vector = func.to_tsvector(cast(config, REGCONFIG), func.coalesce(notes, ''))
+        vector = config_vector if vector is None else vector.op('||', return_type=TSVECTOR)(config_vector)
+    return vector
+
+
+def search_user_mood_notes(search_query: str,
+                           user_id: str = None,
+                           start_period: date = None,
+                           end_period: date = None,
+                           config: str = None,
+                           limit: int = 20,
+                           after: tuple = None
+                           ) -> dict:
+    '''
+    1. Полнотекстовый поиск по причинам настроения (why) через GIN индексы:
+       в горячей таблице — по MoodORM.why_tsv, в архиве — по MoodArchiveORM.whys_tsv, которым по положительной части запроса
+       (querytree) отбираются архивные месяцы.
+       Записи найденных архивных месяцев распаковываются, и каждая проверяется по своему сохранённому tsvector (whys_tsvs)
+    2. search_query разбирается websearch_to_tsquery: поддерживаются "фразы", OR и -исключения.
+       config — 'russian' или 'english'; если None, запрос строится в обеих конфигурациях
+    3. Можно ограничить поиск пользователем user_id и периодом [start_period, end_period]
+    4. Пагинация по ключу (date, id) от новых записей к старым: в after передаётся next_cursor предыдущей страницы,
+       поэтому скорость выдачи не зависит от номера страницы. Для каждой записи считается rank через ts_rank
+    :return: {'results': [{'id', 'user_id', 'date', 'mood', 'weight', 'why', 'rank'}], 'next_cursor': (date, id) или None}
+    '''
+
+    if not search_query or not isinstance(search_query, str):
+        logger.error('ERROR: search_query can\'t be empty')
+        raise ValueError('search_query не должен быть пустой строкой')
+
+    if config is not None and config not in SEARCH_CONFIGS:
+        logger.error(f'ERROR: incorrect search config: {config}')
+        raise ValueError(f'config должен быть одним из {SEARCH_CONFIGS}')
+
+    if not isinstance(limit, int) or limit < 1:
+        raise ValueError('limit must be a positive integer')
+
+    configs = SEARCH_CONFIGS if config is None else (config,)
+    ts_query = func.websearch_to_tsquery(cast(configs[0], REGCONFIG), search_query)
+    for extra_config in configs[1:]:
+        ts_query = ts_query.op('||')(func.websearch_to_tsquery(cast(extra_config, REGCONFIG), search_query))
+
+    # Горячая таблица
+    hot_filters = [MoodORM.why_tsv.bool_op('@@')(ts_query)]
+    if user_id is not None:
+        hot_filters.append(MoodORM.user_id == user_id)
+    if start_period is not None:
+        hot_filters.append(MoodORM.date >= datetime.combine(start_period, time.min))
+    if end_period is not None:
+        hot_filters.append(MoodORM.date <= datetime.combine(end_period, time.max))
+    if after is not None:
+        hot_filters.append(tuple_(MoodORM.date, MoodORM.id) < tuple_(*after))
+
+    hot = select(
+        MoodORM.id,
+        MoodORM.user_id,
+        MoodORM.date,
+        cast(MoodORM.mood, String).label('mood'),
+        cast(MoodORM.weight, String).label('weight'),
+        MoodORM.why,
+        func.ts_rank(MoodORM.why_tsv, ts_query).label('rank'),
+    ).filter(*hot_filters).order_by(MoodORM.date.desc(), MoodORM.id.desc()).limit(limit + 1).subquery('hot')
+
+    # Архив: месяцы отбираются по GIN индексу, затем распакованные записи проверяются по одной
+    unpacked = func.unnest(
+        MoodArchiveORM.ids, MoodArchiveORM.dates, MoodArchiveORM.moods, MoodArchiveORM.weights, MoodArchiveORM.whys,
+        MoodArchiveORM.whys_tsvs,
+    ).table_valued(
+        column('id', Integer), column('date', DateTime), column('mood', String), column('weight', String), column('why', Text),
+        column('why_tsv', TSVECTOR),
+    ).render_derived(name='unpacked')
+    why_tsv = unpacked.c.why_tsv
+
+    archived_filters = [why_tsv.bool_op('@@')(ts_query)]
+    if user_id is not None:
+        archived_filters.append(MoodArchiveORM.user_id == user_id)
+    if start_period is not None:
+        archived_filters.append(MoodArchiveORM.month >= start_period.replace(day=1))
+        archived_filters.append(unpacked.c.date >= datetime.combine(start_period, time.min))
+    if end_period is not None:
+        archived_filters.append(MoodArchiveORM.month <= end_period)
+        archived_filters.append(unpacked.c.date <= datetime.combine(end_period, time.max))
+    if after is not None:
+        archived_filters.append(MoodArchiveORM.month <= after[0].date())
+        archived_filters.append(tuple_(unpacked.c.date, unpacked.c.id) < tuple_(*after))
+
+    with sync_session_fabric() as session:
+        try:
+            # whys_tsv собран из всех заметок месяца, поэтому исключения (-слово) по нему проверять нельзя:
+            # месяц отбрасывался бы из-за чужой заметки. Для отбора месяцев берём только положительную часть запроса,
+            # 'T' означает, что индексируемой части нет, и месяцы отбираются без индекса
+            indexable_query = session.execute(select(func.querytree(ts_query))).scalar()
+            if indexable_query != 'T':
+                archived_filters.append(MoodArchiveORM.whys_tsv.bool_op('@@')(cast(indexable_query, TSQUERY)))
+
+            archived = select(
+                unpacked.c.id,
+                MoodArchiveORM.user_id,
+                unpacked.c.date,
+                unpacked.c.mood,
+                unpacked.c.weight,
+                unpacked.c.why,
+                func.ts_rank(why_tsv, ts_query).label('rank'),
+            ).select_from(MoodArchiveORM).join(unpacked, true()).filter(*archived_filters).order_by(
+                unpacked.c.date.desc(), unpacked.c.id.desc()
+            ).limit(limit + 1).subquery('archived')
+
+            found = union_all(select(hot), select(archived)).subquery('found')
+
+            # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+            query = session.execute(
+                select(found)
+                .order_by(found.c.date.desc(), found.c.id.desc())
+                .limit(limit + 1)
+            ).all()
+
+        except Exception as e:
+            logger.error(f'ERROR during the search {search_query!r} : {str(e)}')
+            raise Exception(f'ERROR: {e}')
+
+    page = query[:limit]
+    next_cursor = (page[-1].date, page[-1].id) if len(query) > limit else None
+
+    logger.info(f'Search {search_query!r} for {user_id=}: found {len(page)} records, next cursor {next_cursor}.')
+
+    results = []
+    for row in page:
+        result = row._asdict()
+        result['mood'] = MoodsEnum[row.mood]
+        result['weight'] = WeightEnun[row.weight]
+        results.append(result)
+
+    return {
+        'results': results,
+        'next_cursor': next_cursor,
+    }